@@ -7,6 +7,10 @@
 #    removed basic auth support
 #    removed dependency on (and support for) gettext localization
 #    removed `digest_password` method
+#    nonces are kept in a store passed in by the caller, so
+#    they outlive a single request; unknown nonces are stale
+#    each nonce count is claimed atomically from the store, so
+#    replays fail (as stale) and counts may arrive out of order
 #
 # please see http://code.google.com/p/django-rest-interface/source/browse/trunk/README
 # for authors, copyrights, and license terms for this file.
@@ -14,12 +18,23 @@
 
 import md5, time, random
 
+class LocalNonceStore(dict):
+    """
+    nonce store for a single process: a dict of the nonces
+    issued, and of the (nonce, nc) pairs claimed so far
+    """
+    def claim(self, nonce, nc):
+        if (nonce, nc) in self:
+            return False
+        self[(nonce, nc)] = True
+        return True
+
 class HttpDigestAuthentication(object):
     """
     HTTP/1.1 digest authentication (RFC 2617).
     Uses code from the Python Paste Project (MIT Licence).
     """    
-    def __init__(self, authfunc, realm='Restricted Access'):
+    def __init__(self, authfunc, realm='Restricted Access', nonce_store=None):
         """
         authfunc:
             A user-defined function which takes a username and
@@ -29,10 +44,19 @@ class HttpDigestAuthentication(object):
         realm:
             An identifier for the authority that is requesting
             authorization
+        nonce_store:
+            A dict-like object mapping the nonces issued to the
+            last nonce count used with each, shared between
+            requests, whose claim(nonce, nc) method returns True
+            only the first time it is called with a given pair.
+            Defaults to a new LocalNonceStore
         """
         self.realm = realm
         self.authfunc = authfunc
-        self.nonce    = {} # prevention of replay attacks
+        if nonce_store is None:
+            nonce_store = LocalNonceStore()
+        self.nonce    = nonce_store # prevention of replay attacks
+        self.stale    = False
 
     def get_auth_dict(self, auth_string):
         """
@@ -96,7 +120,7 @@ class HttpDigestAuthentication(object):
             "%s:%s" % (time.time(), random.random())).hexdigest()
         opaque = md5.md5(
             "%s:%s" % (time.time(), random.random())).hexdigest()
-        self.nonce[nonce] = None
+        self.nonce[nonce] = '00000000'
         parts = {'realm': self.realm, 'qop': 'auth',
                  'nonce': nonce, 'opaque': opaque }
         if stale:
@@ -144,11 +168,17 @@ class HttpDigestAuthentication(object):
             if nonce in self.nonce:
                 del self.nonce[nonce]
             return False
-        pnc = self.nonce.get(nonce,'00000000')
-        if nc <= pnc:
-            if nonce in self.nonce:
-                del self.nonce[nonce]
-            return False # stale = True
+        pnc = self.nonce.get(nonce)
+        if pnc is None:
+            # not one of ours, or expired: the client knows the
+            # password, so tell it to retry with a fresh nonce
+            self.stale = True
+            return False
+        if not self.nonce.claim(nonce, nc):
+            # a replay. the nonce stays usable with other counts,
+            # which may arrive in any order from concurrent requests
+            self.stale = True
+            return False
         self.nonce[nonce] = nc
         return True
     
@@ -0,0 +1,223 @@
+import logging
+import time
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+
+__all__ = ['LocalCache', 'get', 'set', 'add', 'delete', 'incr',
+           'stream_version', 'bump_stream_version', 'stream_last_timestamp',
+           'set_stream_last_timestamp', 'prune_generation', 'bump_prune_generation',
+           'stream_summary', 'set_stream_summary']
+
+class LocalCache(object):
+    """
+    in-process stand-in for memcache, used when the memcache
+    API is not available (e.g. running outside the SDK). keeps
+    at most max_entries values, evicting the least recently
+    used, and honors expiry times like memcache does
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = {}
+        self.clock = 0
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def _expires(self, time_):
+        # memcache treats expiry times over 30 days as absolute
+        if not time_:
+            return None
+        if time_ > 30 * 24 * 60 * 60:
+            return time_
+        return time.time() + time_
+
+    def _evict(self):
+        # drop the least recently used tenth of the entries
+        by_use = [(used, key) for key, (value, expires, used) in self.entries.iteritems()]
+        by_use.sort()
+        for used, key in by_use[:max(1, self.max_entries / 10)]:
+            del self.entries[key]
+
+    def get(self, key):
+        try:
+            value, expires, used = self.entries[key]
+        except KeyError:
+            return None
+        if expires is not None and expires <= time.time():
+            del self.entries[key]
+            return None
+        self.entries[key] = (value, expires, self._tick())
+        return value
+
+    def set(self, key, value, time=0):
+        if key not in self.entries and len(self.entries) >= self.max_entries:
+            self._evict()
+        self.entries[key] = (value, self._expires(time), self._tick())
+        return True
+
+    def add(self, key, value, time=0):
+        if self.get(key) is not None:
+            return False
+        return self.set(key, value, time)
+
+    def delete(self, key):
+        if key in self.entries:
+            del self.entries[key]
+        return True
+
+    def incr(self, key, delta=1, initial_value=None):
+        value = self.get(key)
+        if value is None:
+            if initial_value is None:
+                return None
+            self.set(key, initial_value + delta)
+            return initial_value + delta
+
+        value, expires, used = self.entries[key]
+        self.entries[key] = (value + delta, expires, used)
+        return value + delta
+
+if memcache is not None:
+    backend = memcache
+else:
+    backend = LocalCache()
+
+def get(key):
+    return backend.get(key)
+
+def set(key, value, time=0):
+    # memcache refuses values over 1MB; caching is only ever
+    # an optimization, so don't let that fail the request
+    try:
+        return backend.set(key, value, time)
+    except ValueError, e:
+        logging.debug('not caching %s: %s', key, e)
+        return False
+
+def add(key, value, time=0):
+    try:
+        return backend.add(key, value, time)
+    except ValueError, e:
+        logging.debug('not caching %s: %s', key, e)
+        return False
+
+def delete(key):
+    return backend.delete(key)
+
+def incr(key, delta=1, initial_value=None):
+    return backend.incr(key, delta, initial_value=initial_value)
+
+
+# write versions. every write to a (user, service, type) stream
+# bumps its version, and that of the whole service, so anything
+# cached under the old version is never read again
+def _user_key(user):
+    # a User, or just its key
+    if hasattr(user, 'key'):
+        return user.key()
+    return user
+
+def _version_key(user, service, type):
+    return 'version:%s:%s:%s:%s' % (_user_key(user), service, type or '*', prune_generation(service))
+
+# pruning removes events from the streams of every user of a
+# service at once, without finding out which; bumping the
+# service's prune generation moves all of their versions on
+def _generation_key(service):
+    return 'pruned:%s' % service
+
+def prune_generation(service):
+    key = _generation_key(service)
+    generation = get(key)
+    if generation is None:
+        # as for stream_version, start from the clock so that
+        # an evicted generation is not handed out again
+        add(key, int(time.time() * 1000))
+        generation = get(key)
+    return generation
+
+def bump_prune_generation(service):
+    key = _generation_key(service)
+    if incr(key) is None:
+        add(key, int(time.time() * 1000))
+
+def stream_version(user, service, type=None):
+    """
+    current write version of a stream, or of a whole service
+    if type is None
+    """
+    key = _version_key(user, service, type)
+    version = get(key)
+    if version is None:
+        # start from the clock rather than 0, so a version which
+        # was evicted is not handed out again for different data
+        add(key, int(time.time() * 1000))
+        version = get(key)
+    return version
+
+def bump_stream_version(user, service, type, last_timestamp=None, added=None):
+    """
+    bump the write version of a stream, and of its whole service,
+    after a write. last_timestamp is that of the newest event
+    written, if known, to carry the stream's last timestamp
+    forward to the new version; added is (events, bytes) added
+    to the stream, if known, to carry the service's summary
+    forward too
+    """
+    for t in (type, None):
+        key = _version_key(user, service, t)
+        version = incr(key)
+        if version is None:
+            add(key, int(time.time() * 1000))
+            continue
+
+        # each version follows from the one before by a single
+        # write, so these can be worked out without a query
+        if last_timestamp is not None:
+            previous = get(_last_timestamp_key(user, service, t, version - 1))
+            if previous is not None:
+                set_stream_last_timestamp(user, service, t, version, max(previous, last_timestamp))
+
+        if t is None and added is not None:
+            previous = stream_summary(user, service, version - 1)
+            if previous is not None:
+                # copied, as LocalCache hands out the stored object
+                summary = dict([(k, dict(v)) for k, v in previous.items()])
+                stats = summary.setdefault(type, {'count': 0, 'last_timestamp': 0, 'size': 0})
+                stats['count'] += added[0]
+                stats['size'] += added[1]
+                if last_timestamp is not None:
+                    stats['last_timestamp'] = max(stats['last_timestamp'], last_timestamp)
+                set_stream_summary(user, service, version, summary)
+
+
+# the timestamp of the newest event in a stream as of each write
+# version, so polls need not query the datastore to find it
+def _last_timestamp_key(user, service, type, version):
+    return 'last:%s:%s:%s:%s' % (_user_key(user), service, type or '*', version)
+
+def stream_last_timestamp(user, service, type, version):
+    # None if it is not known for this version
+    return get(_last_timestamp_key(user, service, type, version))
+
+def set_stream_last_timestamp(user, service, type, version, last_timestamp):
+    set(_last_timestamp_key(user, service, type, version), last_timestamp)
+
+
+# the summary of a service (see service.summary) as of each of its
+# write versions, so that it is only built from the journals when
+# a version is missed, or after compaction or pruning
+def _summary_key(user, service, version):
+    return 'summary:%s:%s:%s' % (_user_key(user), service, version)
+
+def stream_summary(user, service, version):
+    # None if it is not known for this version
+    return get(_summary_key(user, service, version))
+
+def set_stream_summary(user, service, version, summary):
+    set(_summary_key(user, service, version), summary)
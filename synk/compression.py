@@ -0,0 +1,89 @@
+import struct
+import zlib
+
+__all__ = ['accepted_encoding', 'compress_chunks', 'decompress']
+
+# content codings we can produce and accept, in order of preference
+encodings = ('gzip', 'deflate')
+
+def accepted_encoding(request):
+    """
+    return the content coding to compress the response to request
+    with, according to its Accept-Encoding header, or None
+    """
+    accepted = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            if param.strip().startswith('q='):
+                try:
+                    quality = float(param.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0.0:
+            return encoding
+    return None
+
+def _gzip_chunks(chunks, level):
+    # gzip is a raw deflate stream between a fixed header and
+    # a trailer of the CRC32 and length of the input
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = zlib.crc32('')
+    size = 0
+
+    # magic, deflate, no flags, no mtime, no extra flags, unknown OS
+    yield '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush() + struct.pack('<II', crc & 0xffffffffL, size & 0xffffffffL)
+
+def _deflate_chunks(chunks, level):
+    compressor = zlib.compressobj(level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compress_chunks(chunks, encoding, level=6):
+    """
+    compress an iterable of strings with the given content coding,
+    a chunk at a time
+    """
+    if encoding == 'gzip':
+        return _gzip_chunks(chunks, level)
+    elif encoding == 'deflate':
+        return _deflate_chunks(chunks, level)
+    raise ValueError('unsupported content coding "%s"' % encoding)
+
+def decompress(data, encoding, max_size):
+    """
+    decompress a request body with the given content coding,
+    refusing to produce more than max_size bytes, so that a small
+    body cannot expand to exhaust memory
+    """
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        decompressor = zlib.decompressobj()
+    else:
+        raise ValueError('unsupported content coding "%s"' % encoding)
+
+    try:
+        out = decompressor.decompress(data, max_size + 1)
+    except zlib.error, e:
+        raise ValueError('could not decompress body: %s' % e)
+
+    if len(out) > max_size:
+        raise ValueError('decompressed body exceeds %d bytes' % max_size)
+    return out
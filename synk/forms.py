@@ -2,6 +2,8 @@ from google.appengine.ext import db
 
 from django import newforms as forms
 
+from synk.models import User
+
 __all__ = ['UserForm']
 
 letters = set([l for l in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz01234567890_.'])
@@ -18,9 +20,9 @@ class UserForm(forms.Form):
                 raise forms.ValidationError('Your username may only contain letters, numbers, underscore (_) and dot (.) characters')
 
         # make sure the username is not already
-        # taken
-        existing_users = db.GqlQuery('select __key__ from User where username = :1 limit 1', username)
-        if existing_users.count() != 0:
+        # taken. User.create checks again when the
+        # user is saved, in case of a race
+        if User.by_username(username) is not None:
             raise forms.ValidationError('That username is already in use')
 
         return username
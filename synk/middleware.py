@@ -1,9 +1,54 @@
+import math
+
 from django.http import HttpResponse
 from django.http import HttpResponseNotAllowed
 
+from django.conf import settings
+
 from authentication import HttpDigestAuthentication
 
-def requires_digest_auth(realm, auth_callback, user_callback):
+from synk import cache
+from synk.ratelimit import rate_limit_wait
+from synk.tokens import check_token
+
+class NonceStore(object):
+    """
+    the nonces issued in Digest challenges, mapped to the last
+    nonce count used with each, and the nonce counts claimed, in
+    memcache (or the in-process cache standing in for it) so that
+    clients can keep using a nonce across requests and instances.
+    a nonce expires after timeout seconds without being used
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def _key(self, nonce):
+        return 'nonce:%s' % nonce
+
+    def get(self, nonce, default=None):
+        nc = cache.get(self._key(nonce))
+        if nc is None:
+            return default
+        return nc
+
+    def __contains__(self, nonce):
+        return self.get(nonce) is not None
+
+    def __setitem__(self, nonce, nc):
+        cache.set(self._key(nonce), nc, self.timeout)
+
+    def __delitem__(self, nonce):
+        cache.delete(self._key(nonce))
+
+    def claim(self, nonce, nc):
+        # add is atomic in memcache, so of several requests with
+        # the same nonce count only one gets True
+        return cache.add('%s:%s' % (self._key(nonce), nc), True, self.timeout)
+
+nonce_store = NonceStore(settings.DIGEST_NONCE_TIME)
+
+def requires_digest_auth(realm, auth_callback, user_callback, token_user_callback=None):
     """
     realm is the realm with which the user's digest password
     was saved. this should basically never change.
@@ -16,11 +61,18 @@ def requires_digest_auth(realm, auth_callback, user_callback):
     user_callback is called only if the authentication process
     was successful, and is given the username as the only
     argument. it should return the user object.
+
+    token_user_callback, if given, allows the request to be
+    authenticated with a bearer token (see synk.tokens) instead.
+    it is called with the username and password fingerprint from
+    a valid token, and should return the user object, or None if
+    it no longer exists or its password has changed.
     """
     def inner(view_func):
         setattr(view_func, 'requires_digest_auth', True)
         setattr(view_func, 'auth_callback', auth_callback)
         setattr(view_func, 'user_callback', user_callback)
+        setattr(view_func, 'token_user_callback', token_user_callback)
         setattr(view_func, 'realm', realm)
         return view_func
     return inner
@@ -46,10 +98,23 @@ class DigestMiddleware(object):
             if user_callback is None or realm is None:
                 raise Exception('error!')
 
-            authenticator = HttpDigestAuthentication(auth_callback, realm)
+            # bearer tokens are checked without any stored state, so
+            # they spare the client the digest challenge round trip
+            token_user_callback = getattr(view_func, 'token_user_callback', None)
+            authorization = request.META.get('HTTP_AUTHORIZATION', '')
+            if token_user_callback is not None and authorization.startswith('Bearer '):
+                credentials = check_token(authorization[len('Bearer '):].strip())
+                user = None
+                if credentials is not None:
+                    user = token_user_callback(*credentials)
+                if user is not None:
+                    setattr(request, 'user', user)
+                    return None
+
+            authenticator = HttpDigestAuthentication(auth_callback, realm, nonce_store)
             if not authenticator.is_authenticated(request):
                 response = HttpResponse('Authorization Required')
-                challenge_headers = authenticator.challenge_headers()                 
+                challenge_headers = authenticator.challenge_headers(authenticator.stale)                 
                 for k,v in challenge_headers.items():                                       
                     response[k] = v
                 response.status_code = 401                                                  
@@ -89,3 +154,25 @@ class AllowedMethodsMiddleware(object):
                 return HttpResponseNotAllowed(allowed_methods)
 
         return None
+
+class RateLimitMiddleware(object):
+    """
+    Middleware to limit the rate of reads and writes by each
+    authenticated user (see READ_RATE_LIMIT and WRITE_RATE_LIMIT),
+    answering requests over the limit with a 429 status. it must
+    come after DigestMiddleware, which sets request.user
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        user = getattr(request, 'user', None)
+        if user is None or not hasattr(user, 'key'):
+            return None
+
+        wait = rate_limit_wait(user, request.method)
+        if wait:
+            response = HttpResponse('Too Many Requests')
+            response['Retry-After'] = str(int(math.ceil(wait)))
+            response.status_code = 429
+            return response
+
+        return None
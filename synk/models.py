@@ -1,14 +1,25 @@
 import types
 import md5
+import bisect
+import heapq
 import pickle
+import struct
 import logging
 import time
 
+import simplejson
+
 from django.conf import settings
 
 from google.appengine.ext import db
 
-__all__ = ['User', 'Journal', 'JournalError', 'serialize', 'deserialize']
+from synk import cache
+
+__all__ = ['User', 'Journal', 'JournalError', 'serialize', 'deserialize',
+           'encode_events', 'decode_events', 'decode_timestamps',
+           'merge_journals', 'without_replaced', 'put_journals', 'event_id_hash',
+           'keyed_field', 'is_keyed', 'key_hash', 'key_index', 'latest_by_key',
+           'replaced_events']
 
 def serialize(obj):
     start = time.time()
@@ -22,10 +33,313 @@ def deserialize(obj):
     logging.debug('deserializing time: %f', time.time() - start)
     return out
 
+# Journal blobs written before the columnar format are a
+# pickled list of event dicts. pickle protocol 0 never starts
+# with a NUL byte, so the magic prefix tells the two apart
+JOURNAL_MAGIC = '\x00SJ'
+JOURNAL_VERSION = 1
+
+# magic, format version, event count
+_journal_header = struct.Struct('<3sBI')
+
+def encode_events(events):
+    """
+    encode a list of event dicts in the columnar journal format:
+
+        header      magic, version, event count
+        timestamps  one little-endian signed 64-bit int per event
+        payloads    compact JSON [schemas, rows], where schemas is a
+                    list of distinct (sorted) key lists and each row
+                    is [schema index, value, value, ...]
+
+    so each key name is stored once per journal rather than once
+    per event. 'timestamp' is stored only in the packed array.
+    """
+    start = time.time()
+
+    timestamps = []
+    schemas = []
+    schema_index = {}
+    rows = []
+
+    for event in events:
+        timestamps.append(event['timestamp'])
+
+        keys = [key for key in event.iterkeys() if key != 'timestamp']
+        keys.sort()
+        keys = tuple(keys)
+        if keys not in schema_index:
+            schema_index[keys] = len(schemas)
+            schemas.append(keys)
+
+        row = [schema_index[keys]]
+        row.extend([event[key] for key in keys])
+        rows.append(row)
+
+    payloads = simplejson.dumps([schemas, rows], separators=(',',':'))
+
+    out = ''.join((
+        _journal_header.pack(JOURNAL_MAGIC, JOURNAL_VERSION, len(timestamps)),
+        struct.pack('<%dq' % len(timestamps), *timestamps),
+        payloads,
+    ))
+    logging.debug('encoding time: %f', time.time() - start)
+    return out
+
+def _decode_header(blob, max_count=None):
+    # the event count from a columnar blob's header, checked
+    # against the length of the blob before anything is sized
+    # by it, and against max_count if given
+    if len(blob) < _journal_header.size:
+        raise JournalError('journal header is truncated')
+
+    magic, version, count = _journal_header.unpack_from(blob)
+    if version != JOURNAL_VERSION:
+        raise JournalError('unknown journal format version %d' % version)
+    if max_count is not None and count > max_count:
+        raise JournalError('journal has more than %d events' % max_count)
+    if len(blob) < _journal_header.size + 8 * count:
+        raise JournalError('journal timestamps are truncated')
+    return count
+
+def decode_timestamps(blob):
+    """
+    return just the packed timestamps of a columnar Journal blob,
+    without decoding the payloads, or None for a legacy blob
+    """
+    if not blob.startswith(JOURNAL_MAGIC):
+        return None
+
+    count = _decode_header(blob)
+    return struct.unpack_from('<%dq' % count, blob, _journal_header.size)
+
+def decode_events(blob, legacy=True, max_count=None):
+    """
+    decode a Journal blob written by encode_events, or a legacy
+    pickled list of event dicts, into a list of event dicts.
+    never pass legacy=True for data which did not come from the
+    datastore: unpickling untrusted data is not safe. for such
+    data, pass max_count to refuse blobs of more events
+    """
+    if not blob.startswith(JOURNAL_MAGIC):
+        if not legacy:
+            raise JournalError('not a columnar journal')
+        return deserialize(blob)
+
+    start = time.time()
+
+    count = _decode_header(blob, max_count)
+
+    offset = _journal_header.size
+    timestamps = struct.unpack_from('<%dq' % count, blob, offset)
+    offset += 8 * count
+
+    schemas, rows = simplejson.loads(blob[offset:])
+
+    out = []
+    for timestamp, row in zip(timestamps, rows):
+        event = dict(zip(schemas[row[0]], row[1:]))
+        event['timestamp'] = timestamp
+        out.append(event)
+
+    logging.debug('decoding time: %f', time.time() - start)
+    return out
+
+def event_id_hash(event_id):
+    """
+    64-bit hash of an event's "id" field, as stored in the
+    id index of the journal holding it
+    """
+    digest = md5.new(simplejson.dumps(event_id)).digest()
+    return struct.unpack('<Q', digest[:8])[0]
+
+def merge_journals(journals, since=0):
+    """
+    generate (journal, event) pairs for every event at or after
+    since in journals, in timestamp order. each journal is sorted
+    on its own, but since every POST is written as a separate
+    segment their time ranges may overlap, so do a k-way merge.
+    ties are broken by journal key, so the order is the same from
+    one request to the next, then by position within the journal
+
+    journals are only decoded when the merge reaches their
+    first_timestamp, and released once they are used up, so only
+    the journals which overlap in time are held decoded at once.
+    journals replaced by another of them (see Journal.replaces)
+    are skipped
+    """
+    # journals is often a query, which would run again each
+    # time it is iterated
+    journals = without_replaced(list(journals))
+
+    # heap entries are (timestamp, order, offset, journal, events);
+    # events is None for journals not yet decoded, in which case
+    # timestamp is a lower bound from the metadata
+    heap = []
+    for position, journal in enumerate(journals):
+        if journal.is_saved():
+            order = (str(journal.key()), position)
+        else:
+            order = ('', position)
+        heap.append((max(journal.first_timestamp, since), order, 0, journal, None))
+    heapq.heapify(heap)
+
+    while heap:
+        timestamp, order, offset, journal, events = heap[0]
+        if events is None:
+            events = journal.events_since(since)
+            if events:
+                heapq.heapreplace(heap, (events[0]['timestamp'], order, 0, journal, events))
+            else:
+                heapq.heappop(heap)
+            continue
+
+        yield journal, events[offset]
+
+        offset += 1
+        if offset < len(events):
+            heapq.heapreplace(heap, (events[offset]['timestamp'], order, offset, journal, events))
+        else:
+            heapq.heappop(heap)
+            journal.release()
+
+def without_replaced(journals):
+    # journals, less any which another of them replaces
+    replaced = set()
+    for journal in journals:
+        replaced.update([str(key) for key in journal.replaces])
+    if not replaced:
+        return journals
+    return [journal for journal in journals
+            if not journal.is_saved() or str(journal.key()) not in replaced]
+
+def keyed_field(service, type):
+    """
+    the field a stream is keyed by (see KEYED_STREAMS in the
+    settings), or None if it is not keyed
+    """
+    return settings.KEYED_STREAMS.get('%s/%s' % (service, type))
+
+def is_keyed(service, type=None):
+    # True if the stream, or any stream of the service if
+    # type is None, is keyed
+    if type is not None:
+        return keyed_field(service, type) is not None
+    for stream in settings.KEYED_STREAMS:
+        if stream.split('/', 1)[0] == service:
+            return True
+    return False
+
+def key_hash(value):
+    """
+    64-bit hash of the value of a keyed stream's key field, as
+    stored in the event_keys of the journals holding it. 0 is
+    reserved for events without the field
+    """
+    # the value may be any JSON value, so hash its encoding
+    digest = md5.new(simplejson.dumps(value, sort_keys=True)).digest()
+    return struct.unpack('<Q', digest[:8])[0] or 1
+
+def _merge_order(journal):
+    # how merge_journals orders journals' events which share a
+    # timestamp, for journals which have been put
+    if journal.is_saved():
+        return str(journal.key())
+    return ''
+
+def key_index(journals, since=0):
+    """
+    the latest-by-key index of journals: for each key of a keyed
+    stream, as (service, type, key_hash), a list [timestamp, journal
+    order, n] locating its latest event at or after since, n being
+    how many events of the key that journal has at that timestamp.
+    built from the journals' packed timestamps and event_keys, so
+    without decoding their events, and only as big as the number
+    of distinct keys
+    """
+    index = {}
+    for journal in without_replaced(journals):
+        if keyed_field(journal.service, journal.type) is None:
+            continue
+
+        order = _merge_order(journal)
+        for timestamp, hashed in journal.keys_since(since):
+            if not hashed:
+                continue
+            key = (journal.service, journal.type, hashed)
+            latest = index.get(key)
+            if latest is None or (timestamp, order) > (latest[0], latest[1]):
+                index[key] = [timestamp, order, 1]
+            elif (timestamp, order) == (latest[0], latest[1]):
+                latest[2] += 1
+    return index
+
+def latest_by_key(pairs, index):
+    """
+    filter (journal, event) pairs from merge_journals, keeping only
+    the events index (see key_index) has as the latest for their
+    key; events of other streams, or without the key field, all
+    pass. nothing is held back: each pair is generated as soon as
+    it is known to be the latest. index is used up in the process
+    """
+    for journal, item in pairs:
+        field = keyed_field(journal.service, journal.type)
+        if field is not None and field in item:
+            latest = index.get((journal.service, journal.type, key_hash(item[field])))
+            if latest is not None:
+                if (latest[0], latest[1]) != (item['timestamp'], _merge_order(journal)):
+                    continue
+                # of several events of the key at the same timestamp
+                # in one journal, merge_journals yields the last one last
+                latest[2] -= 1
+                if latest[2]:
+                    continue
+        yield journal, item
+
+def replaced_events(journal, index):
+    """
+    number of the events of journal which index (see key_index)
+    has replaced by a later event of the same key
+    """
+    # one event is kept for each key whose latest is in this
+    # journal; every other one with a key has been replaced
+    order = _merge_order(journal)
+    keyed = 0
+    latest_here = set()
+    for timestamp, hashed in journal.keys_since(0):
+        if not hashed:
+            continue
+        keyed += 1
+        key = (journal.service, journal.type, hashed)
+        latest = index.get(key)
+        if latest is not None and (latest[0], latest[1]) == (timestamp, order):
+            latest_here.add(key)
+    return keyed - len(latest_here)
+
+def put_journals(journals):
+    """
+    put several journals with a single datastore call. db.put()
+    does not call Journal.put(), so encode each one first
+    """
+    for journal in journals:
+        journal._prepare_put()
+    db.put(journals)
+
+# recently used User entities by username, so that authenticating
+# a request (which looks the user up twice) usually needs no query.
+# memcache backs this up across instances; entries expire quickly so
+# that a password change made elsewhere is soon picked up
+_users = cache.LocalCache(settings.USER_CACHE_SIZE)
+
 class User(db.Model):
     username = db.StringProperty()
     password_hash = db.StringProperty()
 
+    # for users created before key names were used, the UNIX time
+    # at which the migrate_users task moved their journals to the
+    # key-named user; they are deleted by a later run
+    migrated = db.IntegerProperty()
+
     # pretend to be a property
     realm = 'Synk'
 
@@ -34,6 +348,11 @@ class User(db.Model):
         a1 = '%s:%s:%s' % (self.username, self.realm, password)
         ha1 = md5.new(a1)
         self.password_hash = ha1.hexdigest()
+        User.forget(self.username)
+
+    def put(self):
+        db.Model.put(self)
+        User.forget(self.username)
 
     def journals(self, service=None, type=None, last_timestamp=None, limit=''):
         # get journals, optionally filtering by service, type,
@@ -59,20 +378,79 @@ class User(db.Model):
         if limit is not '':
             limit = ' limit %d' % limit
 
+        # every journal returned has last_timestamp >= the given
+        # last_timestamp; use Journal.straddles() to tell the (at
+        # most few) journals which also hold older events from the
+        # ones which lie entirely inside the window
         query = 'select * from Journal where user = :1 %s order by last_timestamp desc %s' % (predicate, limit)
         journals = db.GqlQuery(query, *args)
         return journals
 
+    @staticmethod
+    def key_name_for(username):
+        # users are stored with a key name derived from their
+        # username, so they can be looked up with a get. the
+        # prefix keeps usernames which start with a digit or
+        # "__" (not allowed in key names) usable
+        return 'u:%s' % username
+
+    @staticmethod
+    def create(username, password):
+        """
+        create and put a new user, or return None if the username
+        is taken. the check and the put happen in one transaction,
+        so two registrations cannot both get the same username
+        """
+        key_name = User.key_name_for(username)
+        def txn():
+            if User.get_by_key_name(key_name) is not None:
+                return None
+            user = User(key_name=key_name, username=username)
+            user.set_password(password)
+            user.put()
+            return user
+        return db.run_in_transaction(txn)
+
     @staticmethod
     def by_username(username):
+        user = User.get_by_key_name(User.key_name_for(username))
+        if user is not None:
+            return user
+
+        # users created before key names were used; these are
+        # moved over by the migrate_users task, after which
+        # this query always comes up empty
         try:
             user = db.GqlQuery('select * from User where username = :1 limit 1', username)[0]
             return user
         except IndexError:
             return None
 
+    @staticmethod
+    def cached_by_username(username):
+        """
+        like by_username, but answered from the in-process cache
+        or memcache where possible
+        """
+        user = _users.get(username)
+        if user is None:
+            user = cache.get('user:%s' % username)
+            if user is None:
+                user = User.by_username(username)
+                if user is None:
+                    return None
+                cache.set('user:%s' % username, user, settings.USER_CACHE_TIME)
+            _users.set(username, user, settings.USER_CACHE_TIME)
+        return user
+
+    @staticmethod
+    def forget(username):
+        # drop a user from the caches, after it changes
+        _users.delete(username)
+        cache.delete('user:%s' % username)
+
 class JournalError(Exception):
-    """Raised when the status is at its max_size already"""
+    """Raised when the Journal is at its max_bytes already"""
     pass
 
 class Journal(db.Model):
@@ -91,42 +469,217 @@ class Journal(db.Model):
     # is never less than the last timestamp
     last_timestamp = db.IntegerProperty()
 
+    # timestamp of the earliest event in the Journal, set
+    # by put(). None for journals written before this
+    # property existed
+    first_timestamp = db.IntegerProperty()
+
     # serialized python dictionary mapping item id
     # to status key
     events_serialized = db.BlobProperty(default=None)
-    events = None
+
+    # decoded list of events; see _get_events. _modified is
+    # True when they differ from events_serialized
+    _events = None
+    _modified = False
     
-    # maximum number of elements per Journal
-    #
-    # max size per item is about 2048 bytes, but we expect
-    # many items to be much shorter than that (hopefully!)
-    max_size = 1000 
+    # approximate maximum size of the journal's blobs (events,
+    # plus the id and key indexes), in bytes, which must keep
+    # the entity under the datastore's 1MB limit. events are
+    # packed into a Journal until adding another would take it
+    # past this budget
+    max_bytes = settings.JOURNAL_MAX_BYTES
+
+    # running estimate of the encoded size; see _estimated_size
+    _size_estimate = None
+    _estimated_schemas = None
 
     size = db.IntegerProperty()
     count = db.IntegerProperty()
     fill_factor = db.FloatProperty()
 
-    def __init__(self, *args, **kwargs):
-        db.Model.__init__(self, *args, **kwargs)
+    # True for journals written directly by a POST, which hold
+    # just that request's events and are never modified after
+    # being put; readers merge them with the other journals
+    segment = db.BooleanProperty(default=False)
+
+    # sorted, packed 64-bit hashes of the "id" fields of the
+    # events which have one, so that a POST can recognize events
+    # it already holds without decoding events_serialized
+    event_ids = db.BlobProperty(default=None)
+    _event_id_hashes = None
+
+    # keys of the journals a compaction merged into this one. they
+    # are deleted after this is put, but if that never happens
+    # they are skipped when read, and deleted by the next run
+    replaces = db.ListProperty(db.Key)
+
+    # for keyed streams, the packed key_hash of the key field of
+    # each event, in the same order as the events (0 for events
+    # without it); see key_index
+    event_keys = db.BlobProperty(default=None)
+
+    def _get_events(self):
+        # decode events_serialized only on first access, so
+        # that callers which only look at metadata (count,
+        # last_timestamp, service, ...) never touch the blob
+        if self._events is None:
+            if self.events_serialized:
+                self._events = decode_events(self.events_serialized)
+            else:
+                self._events = []
+        return self._events
+
+    def _set_events(self, events):
+        self._events = events
+        self._modified = True
+
+    events = property(_get_events, _set_events)
+
+    def is_decoded(self):
+        return self._events is not None
+
+    def release(self):
+        # drop the decoded events if they still match the blob;
+        # they are decoded again if needed
+        if not self._modified and self.events_serialized:
+            self._events = None
+
+    def _blob_size(self):
+        return len(self.events_serialized or '') + len(self.event_ids or '') + len(self.event_keys or '')
+
+    def _estimated_size(self):
+        # size of the blobs as of the last put(), plus the
+        # estimated cost of everything added since, so that
+        # checking the budget never requires re-encoding
+        if self._size_estimate is None:
+            if self.events_serialized:
+                self._size_estimate = self._blob_size()
+            else:
+                self._size_estimate = len(encode_events([]))
+        return self._size_estimate
+
+    def _estimate_event_size(self, value):
+        # approximate number of bytes value adds to the output
+        # of encode_events: a packed timestamp, a JSON row, and
+        # the key list the first time a new set of keys is seen;
+        # plus its entry in event_ids, if it has an id, and in
+        # event_keys, if the stream is keyed
+        if self._estimated_schemas is None:
+            self._estimated_schemas = set()
+
+        keys = [key for key in value.iterkeys() if key != 'timestamp']
+        keys.sort()
+        row = [0] + [value[key] for key in keys]
+        size = 8 + len(simplejson.dumps(row, separators=(',',':'))) + 1
+        if 'id' in value:
+            size += 8
+        if keyed_field(self.service, self.type) is not None:
+            size += 8
+
+        keys = tuple(keys)
+        if keys not in self._estimated_schemas:
+            self._estimated_schemas.add(keys)
+            size += len(simplejson.dumps(keys, separators=(',',':'))) + 1
+
+        return size
+
+    def straddles(self, since):
+        """
+        True if this journal may hold events both before and at or
+        after since; False if every event is at or after since.
+        answered from metadata alone, without decoding
+        """
+        return self.first_timestamp is None or self.first_timestamp < since
+
+    def events_since(self, since):
+        """
+        return a list of the events with timestamp >= since
+        """
+        if not self.straddles(since):
+            return self.events
+
+        if self.is_decoded():
+            # may have been modified since it was loaded,
+            # so it is not necessarily sorted any more
+            return [item for item in self.events if item['timestamp'] >= since]
+
+        # put() always stores events sorted by timestamp, so
+        # binary search for the first one in the window
+        timestamps = decode_timestamps(self.events_serialized or '')
+        if timestamps is None:
+            timestamps = [item['timestamp'] for item in self.events]
+        return self.events[bisect.bisect_left(timestamps, since):]
+
+    def _key_hash(self, item, field):
+        if field in item:
+            return key_hash(item[field])
+        return 0
+
+    def keys_since(self, since):
+        """
+        return (timestamp, key_hash) pairs for the events with
+        timestamp >= since, in order, the hash being 0 for events
+        without the stream's key field. read from the packed
+        timestamps and event_keys as of the last put, if it has
+        not been modified since, without decoding the events
+        """
+        field = keyed_field(self.service, self.type)
+
+        timestamps = None
+        if not self._modified and self.events_serialized:
+            timestamps = decode_timestamps(self.events_serialized)
+        if timestamps is None or field is None or len(self.event_keys or '') != 8 * len(timestamps):
+            return [(item['timestamp'], self._key_hash(item, field)) for item in self.events_since(since)]
+
+        hashes = struct.unpack('<%dQ' % len(timestamps), self.event_keys)
+        start = bisect.bisect_left(timestamps, since)
+        return zip(timestamps[start:], hashes[start:])
+
+    def _prepare_put(self):
+        # sort before saving
+        self.events.sort(key=lambda item: item['timestamp'])
 
-        if self.events_serialized:
-            self.events = deserialize(self.events_serialized)
-        else:
-            self.events = []
+        self.events_serialized = encode_events(self.events)
 
-    def is_full(self):
-        return len(self.events) >= self.max_size
+        if self.events:
+            self.first_timestamp = self.events[0]['timestamp']
 
-    def put(self):
-        # sort before saving
-        self.events.sort(key=lambda item: item['timestamp'])
+        field = keyed_field(self.service, self.type)
+        if field is not None:
+            keys = [self._key_hash(item, field) for item in self.events]
+            self.event_keys = struct.pack('<%dQ' % len(keys), *keys)
+        else:
+            self.event_keys = None
 
-        self.events_serialized = serialize(self.events)
+        ids = [event_id_hash(item['id']) for item in self.events if 'id' in item]
+        ids.sort()
+        self.event_ids = struct.pack('<%dQ' % len(ids), *ids)
+        self._event_id_hashes = None
 
-        self.size = len(self.events_serialized)
+        self.size = self._blob_size()
         self.count = len(self.events)
-        self.fill_factor = float(self.size) / 900000.0
+        self.fill_factor = float(self.size) / self.max_bytes
+
+        self._size_estimate = self.size
+        self._modified = False
+
+    def has_event_id(self, id_hash):
+        """
+        True if the journal holds an event whose "id" field has
+        the given event_id_hash, as of the last put
+        """
+        if not self.event_ids:
+            return False
+        if self._event_id_hashes is None:
+            self._event_id_hashes = struct.unpack('<%dQ' % (len(self.event_ids) / 8), self.event_ids)
 
+        ids = self._event_id_hashes
+        i = bisect.bisect_left(ids, id_hash)
+        return i < len(ids) and ids[i] == id_hash
+
+    def put(self):
+        self._prepare_put()
         db.Model.put(self)
 
     def _check_value_for_add(self, value):
@@ -137,15 +690,23 @@ class Journal(db.Model):
             # don't expect this to happen ever, really
             raise JournalError('journal elements must be dictionaries')
 
-        if self.is_full():
+        size = self._estimate_event_size(value)
+        if len(self) and self._estimated_size() + size > self.max_bytes:
             raise JournalError('journal is already full')
+        self._size_estimate = self._estimated_size() + size
+
+        self._modified = True
 
         if 'timestamp' in value and value['timestamp'] > self.last_timestamp:
             self.last_timestamp = value['timestamp']
+        if 'timestamp' in value and self.first_timestamp is not None and value['timestamp'] < self.first_timestamp:
+            self.first_timestamp = value['timestamp']
 
 
     # implement sequence protocol
     def __len__(self):
+        if not self.is_decoded() and self.count is not None:
+            return self.count
         return len(self.events)
 
     def __contains__(self, element):
@@ -168,6 +729,7 @@ class Journal(db.Model):
 
     def __delitem__(self, key):
         del self.events[key]
+        self._modified = True
 
     def __iter__(self):
         return iter(self.events)
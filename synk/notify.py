@@ -0,0 +1,73 @@
+import threading
+import time
+
+from synk import cache
+
+__all__ = ['Notifier', 'notify', 'wait_for_write']
+
+class Notifier(object):
+    """
+    in-process publish/subscribe for stream writes: requests in
+    this process waiting on a key are woken when it is notified
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # key => [condition, number of waiters]
+        self.waiting = {}
+
+    def wait(self, key, timeout):
+        self.lock.acquire()
+        try:
+            entry = self.waiting.setdefault(key, [threading.Condition(self.lock), 0])
+            entry[1] += 1
+            try:
+                entry[0].wait(timeout)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.waiting[key]
+        finally:
+            self.lock.release()
+
+    def notify(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.waiting:
+                self.waiting[key][0].notifyAll()
+        finally:
+            self.lock.release()
+
+notifier = Notifier()
+
+def _key(user, service, type):
+    return '%s:%s:%s' % (user.key(), service, type or '*')
+
+def notify(user, service, type):
+    """
+    wake requests waiting on the stream, or on its whole service.
+    call after the stream's write version has been bumped
+    """
+    notifier.notify(_key(user, service, type))
+    notifier.notify(_key(user, service, None))
+
+def wait_for_write(user, service, type, version, timeout, interval=1.0):
+    """
+    wait up to timeout seconds for the write version of a stream
+    (or of a whole service, if type is None) to move on from
+    version. returns True if it did
+
+    writes in this process wake the wait straight away; the
+    version is also checked every interval seconds, to notice
+    writes handled by other processes
+    """
+    deadline = time.time() + timeout
+    while True:
+        if cache.stream_version(user, service, type) != version:
+            return True
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        notifier.wait(_key(user, service, type), min(interval, remaining))
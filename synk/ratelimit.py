@@ -0,0 +1,53 @@
+import math
+import time
+
+from django.conf import settings
+
+from synk import cache
+
+__all__ = ['take_token', 'rate_limit_wait']
+
+def take_token(key, rate, burst, now=None):
+    """
+    take a token from the bucket stored under key, which refills
+    at rate tokens per second up to burst tokens. returns 0 if
+    one was taken, otherwise the seconds until one will be there
+
+    the bucket is read and written back without a lock, so two
+    instances racing on it may both be let through; that's fine
+    for keeping a client from hammering us
+    """
+    if now is None:
+        now = time.time()
+
+    state = cache.get(key)
+    if state is None:
+        # a missing (or evicted) bucket is a full one
+        tokens, last = burst, now
+    else:
+        tokens, last = state
+    tokens = min(burst, tokens + max(0, now - last) * rate)
+
+    if tokens < 1:
+        return (1 - tokens) / float(rate)
+
+    # once it has refilled it is the same as a missing one,
+    # so there's no need to keep it any longer than that
+    cache.set(key, (tokens - 1, now), int(math.ceil(burst / float(rate))) + 1)
+    return 0
+
+def rate_limit_wait(user, method):
+    """
+    charge a request by user to its read (GET and HEAD) or write
+    (anything else) bucket. returns 0 if it may go ahead, or the
+    seconds it should wait before trying again
+    """
+    if method in ('GET', 'HEAD'):
+        kind, limit = 'read', settings.READ_RATE_LIMIT
+    else:
+        kind, limit = 'write', settings.WRITE_RATE_LIMIT
+    if limit is None:
+        return 0
+
+    rate, burst = limit
+    return take_token('ratelimit:%s:%s' % (kind, user.key()), rate, burst)
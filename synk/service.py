@@ -1,3 +1,5 @@
+import base64
+import hashlib
 import logging
 import sys
 import time
@@ -5,28 +7,49 @@ import types
 
 import simplejson
 
+from django.conf import settings
 from django.http import HttpResponse
+from django.http import HttpResponseNotModified
 from django.http import HttpResponseServerError
 
 from google.appengine.ext.webapp import template
 
 from synk.models import *
+from synk import cache
+from synk import notify
+from synk.tokens import make_token
+from synk.tokens import password_matches
+from synk.compression import *
 
 from synk.middleware import requires_digest_auth
 from synk.middleware import allow_method
 
 
 def authenticate_user(realm, username):
-    u = User.by_username(username)
+    u = User.cached_by_username(username)
     if u is None:
         return ''
     return u.password_hash
 
 def get_user(username):
-    u = User.by_username(username)
+    u = User.cached_by_username(username)
+    return u
+
+def get_token_user(username, fingerprint):
+    # the user a token was issued to, unless the password
+    # has been changed since
+    u = User.cached_by_username(username)
+    if u is None or not password_matches(fingerprint, u.password_hash):
+        return None
     return u
 
 def require_auth(func):
+    decorator_wrapper = requires_digest_auth(realm=User.realm, auth_callback=authenticate_user, user_callback=get_user,
+            token_user_callback=get_token_user)
+    return decorator_wrapper(func)
+
+def require_digest_auth(func):
+    # like require_auth, but not satisfied by a bearer token
     decorator_wrapper = requires_digest_auth(realm=User.realm, auth_callback=authenticate_user, user_callback=get_user)
     return decorator_wrapper(func)
 
@@ -43,13 +66,171 @@ def JsonResponse(body=None, error=False, **kwargs):
     else:
         return HttpResponse(out, 'text/json')
 
-def validate_put_post(raw_body):
+def iterencode_list(items, chunk_size=8192):
+    # encode a (possibly lazy) sequence as a JSON array, a
+    # chunk at a time, without building the whole list or string
+    encoder = simplejson.JSONEncoder(separators=(',',':'))
+
+    pending = ['[']
+    pending_size = 1
+    for i, item in enumerate(items):
+        if i:
+            pending.append(',')
+        for chunk in encoder.iterencode(item):
+            pending.append(chunk)
+            pending_size += len(chunk)
+
+        if pending_size >= chunk_size:
+            yield ''.join(pending)
+            pending = []
+            pending_size = 0
+
+    pending.append(']')
+    yield ''.join(pending)
+
+def iterencode_lines(items, chunk_size=8192):
+    # encode a (possibly lazy) sequence as newline-delimited
+    # JSON, one item per line, a chunk at a time
+    encoder = simplejson.JSONEncoder(separators=(',',':'))
+
+    pending = []
+    pending_size = 0
+    for item in items:
+        for chunk in encoder.iterencode(item):
+            pending.append(chunk)
+            pending_size += len(chunk)
+        pending.append('\n')
+
+        if pending_size >= chunk_size:
+            yield ''.join(pending)
+            pending = []
+            pending_size = 0
+
+    yield ''.join(pending)
+
+def StreamResponse(chunks, content_type, encoding=None):
+    # an HttpResponse written from an iterable of strings,
+    # compressed with encoding if it is given
+    if encoding is None:
+        return HttpResponse(chunks, content_type)
+
+    response = HttpResponse(compress_chunks(chunks, encoding), content_type)
+    response['Content-Encoding'] = encoding
+    return response
+
+def JsonStreamResponse(items, encoding=None):
+    """
+    like JsonResponse for a list, but items may be any iterable,
+    which is consumed and encoded as the response is written out.
+    if encoding is given, the output is compressed with it as well
+    """
+    return StreamResponse(iterencode_list(items), 'text/json', encoding)
+
+# media types for events besides JSON: newline-delimited JSON, one
+# event per line, which can be produced and parsed incrementally;
+# and the columnar journal format (see encode_events), which is
+# more compact but must be built and parsed all at once
+NDJSON = 'application/x-ndjson'
+BINARY = 'application/x-synk-events'
+
+def media_type(header):
+    # "application/x-ndjson; charset=utf-8" => "application/x-ndjson"
+    return header.split(';')[0].strip().lower()
+
+def accepted_format(request):
+    # the first of the alternative media types named in the
+    # request's Accept header, or None for plain JSON
+    for accepted in request.META.get('HTTP_ACCEPT', '').split(','):
+        if media_type(accepted) not in (NDJSON, BINARY):
+            continue
+        for param in accepted.split(';')[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    if float(param[2:]) <= 0.0:
+                        break
+                except ValueError:
+                    break
+        else:
+            return media_type(accepted)
+    return None
+
+def EventsResponse(request, items):
+    """
+    a response for a GET of events, in the media type and with
+    the compression the request asks for
+    """
+    format = accepted_format(request)
+    encoding = accepted_encoding(request)
+
+    if format == NDJSON:
+        response = StreamResponse(iterencode_lines(items), NDJSON, encoding)
+    elif format == BINARY:
+        response = StreamResponse([encode_events(list(items))], BINARY, encoding)
+    else:
+        response = JsonStreamResponse(items, encoding)
+
+    response['Vary'] = 'Accept, Accept-Encoding'
+    return response
+
+def post_body(request):
+    # the POST body, decompressed if it was sent compressed
+    body = request.raw_post_data
+    if 'HTTP_CONTENT_ENCODING' in request.META:
+        encoding = request.META['HTTP_CONTENT_ENCODING'].strip().lower()
+        if encoding != 'identity':
+            body = decompress(body, encoding, settings.MAX_POST_BYTES)
+    return body
+
+def iterlines(text):
+    # the lines of text, without copying it all at once
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text)
+        yield text[start:end]
+        start = end + 1
+
+def parse_put_post(raw_body, content_type=None):
+    # decode a PUT/POST body into a list of items, according
+    # to its media type
+    content_type = media_type(content_type or '')
+
+    if content_type == NDJSON:
+        items = []
+        for i, line in enumerate(iterlines(raw_body)):
+            if not line.strip():
+                continue
+            try:
+                items.append(simplejson.loads(line))
+            except:
+                raise Exception('could not parse JSON on line %d' % (i + 1))
+        return items
+
+    elif content_type == BINARY:
+        try:
+            return decode_events(raw_body, legacy=False, max_count=settings.MAX_POST_EVENTS)
+        except:
+            raise Exception('could not parse %s body' % BINARY)
+
+    try:
+        return simplejson.loads(raw_body)
+    except:
+        raise Exception('could not parse JSON')
+
+def validate_put_post(raw_body, streams=False, content_type=None):
     # a valid PUT/POST body contains a JSON representation
-    # of an array of objects. each object should contain
+    # of an array of objects (or one of the alternative media
+    # types, see parse_put_post). each object should contain
     # the following fields:
     #
     # timestamp (int)
     # 
+    # if streams is True, each object must also contain
+    # "service" and "type" (strings), naming the stream it
+    # belongs to; otherwise they are not allowed.
+    #
     # each object may contain any number of other fields,
     # nested as deeply as desired, so long as the total
     # length of JSON of remaining objects is no greater
@@ -67,10 +248,7 @@ def validate_put_post(raw_body):
         else:
             return thing
 
-    try:
-        items = simplejson.loads(raw_body)
-    except:
-        raise Exception('could not parse JSON')
+    items = parse_put_post(raw_body, content_type)
 
     if type(items) != types.ListType:
         raise Exception('JSON top-level element was not an array')
@@ -85,20 +263,191 @@ def validate_put_post(raw_body):
             raise Exception('item %d did not have "timestamp" field' % i)
         if type(item['timestamp']) not in (types.IntType, types.LongType):
             raise Exception('item %d did not have integer "timestamp" field' % i)
+        if not -2**63 <= item['timestamp'] < 2**63:
+            # journals store timestamps as signed 64-bit integers
+            raise Exception('item %d had "timestamp" field out of range' % i)
+
+        if 'id' in item and type(item['id']) not in (types.StringType, types.UnicodeType, types.IntType, types.LongType):
+            raise Exception('item %d had "id" field which was not a string or integer' % i)
 
-        if 'service' in item:
-            raise Exception('item %d contained invalid key "service"' % i)
-        if 'type' in item:
-            raise Exception('item %d contained invalid key "type"' % i)
-        
         data = dict(item)
         del data['timestamp']
+
+        for key in ('service', 'type'):
+            if not streams and key in item:
+                raise Exception('item %d contained invalid key "%s"' % (i, key))
+            if streams:
+                if type(item.get(key)) not in (types.StringType, types.UnicodeType):
+                    raise Exception('item %d did not have string "%s" field' % (i, key))
+                if not item[key] or '/' in item[key]:
+                    raise Exception('item %d had invalid "%s" field' % (i, key))
+                if key == 'type' and item[key] in ('all', 'summary'):
+                    # these name other resources in the URLs of a service
+                    raise Exception('item %d had reserved "type" "%s"' % (i, item[key]))
+                del data[key]
+
         if len(serialize(data)) > 2048:
             raise Exception('item %d exceeds 2048 bytes of data' % i)
 
     return items
 
 
+def assign_batch_ids(request, items):
+    # a client may name each POST with an X-Synk-Batch-Id header,
+    # so that a retry of the whole POST can be recognized; items
+    # without an id of their own get one derived from it
+    batch_id = request.META.get('HTTP_X_SYNK_BATCH_ID')
+    if batch_id:
+        for i, item in enumerate(items):
+            if 'id' not in item:
+                item['id'] = '%s/%d' % (batch_id, i)
+
+def drop_duplicates(user, service, type, items):
+    """
+    return items (sorted by timestamp) without those whose id the
+    stream already holds, or which repeat an earlier item's id
+
+    a retried event has the same timestamp as the original, so
+    only journals overlapping the items' time range are checked,
+    using their id index rather than their events
+    """
+    with_ids = [item for item in items if 'id' in item]
+    if not with_ids:
+        return items
+
+    first, last = items[0]['timestamp'], items[-1]['timestamp']
+    journals = [journal for journal in user.journals(service=service, type=type, last_timestamp=first)
+                if journal.first_timestamp is None or journal.first_timestamp <= last]
+
+    seen = set()
+    out = []
+    for item in items:
+        if 'id' in item:
+            id_hash = event_id_hash(item['id'])
+            if id_hash in seen:
+                continue
+            seen.add(id_hash)
+            if any(journal.has_event_id(id_hash) for journal in journals):
+                continue
+        out.append(item)
+
+    if len(out) < len(items):
+        logging.info('dropped %d duplicate events', len(items) - len(out))
+    return out
+
+def journal_events(journals, since, keyed=False):
+    # events of journals in timestamp order, tagged with the
+    # service and type they belong to. if keyed is True, only
+    # the latest event for each key of keyed streams is kept.
+    # journals may be a query, so fetch them just once for both
+    journals = list(journals)
+    pairs = merge_journals(journals, since)
+    if keyed:
+        pairs = latest_by_key(pairs, key_index(journals, since))
+
+    for journal, item in pairs:
+        item['service'] = journal.service
+        item['type'] = journal.type
+        yield item
+
+def stream_last_timestamp(user, service, type, version):
+    # last_timestamp of the stream's newest journal as of the
+    # given write version. POSTs normally keep this up to date in
+    # the cache; otherwise it is looked up once per version
+    last_timestamp = cache.stream_last_timestamp(user, service, type, version)
+    if last_timestamp is None:
+        last_timestamp = 0
+        for journal in user.journals(service=service, type=type, limit=1):
+            last_timestamp = journal.last_timestamp
+        cache.set_stream_last_timestamp(user, service, type, version, last_timestamp)
+    return last_timestamp
+
+def stream_etag(request, version, since):
+    # the write version changes with every write to the stream,
+    # and is never handed out again after an eviction. the rest
+    # of the query and the format are folded in, so that the tag
+    # of one page or variant does not vouch for another; it is
+    # weak, since the same events are sent with several encodings
+    query = '%d:%s:%s:%s' % (since, request.GET.get('limit', ''), request.GET.get('cursor', ''),
+                             accepted_format(request) or 'json')
+    return 'W/"%s-%s"' % (version, hashlib.md5(query).hexdigest()[:12])
+
+def _weak(tag):
+    if tag.startswith('W/'):
+        return tag[2:]
+    return tag
+
+def etag_matches(request, etag):
+    # If-None-Match uses the weak comparison
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if if_none_match.strip() == '*':
+        return True
+    return _weak(etag) in [_weak(tag.strip()) for tag in if_none_match.split(',')]
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode('%d:%s:%d' % position)
+
+def decode_cursor(cursor):
+    try:
+        timestamp, key, count = base64.urlsafe_b64decode(str(cursor)).split(':')
+        return int(timestamp), key, int(count)
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor')
+
+def page_events(journals, since, limit, cursor=None):
+    """
+    return a list of up to limit tagged events of journals at or
+    after since, and the position of the last one if there are more
+    events after it (or None). a position (timestamp, journal key,
+    count) is the count'th event at timestamp in the journal with
+    that key, which is unambiguous in the order merge_journals
+    produces. events up to and including cursor, a position from
+    an earlier page, are skipped
+
+    pages of keyed streams are not filtered down to the latest
+    event for each key, since that would mean reading the whole
+    stream for every page; the events replaced are all earlier
+    than the ones replacing them, so a client which applies the
+    events in order ends up in the same state
+    """
+    pairs = merge_journals(journals, since)
+
+    out = []
+    position = last = None
+    for journal, item in pairs:
+        timestamp, key = item['timestamp'], str(journal.key())
+        if position is not None and position[:2] == (timestamp, key):
+            position = (timestamp, key, position[2] + 1)
+        else:
+            position = (timestamp, key, 1)
+
+        if cursor is not None and position <= cursor:
+            continue
+        if len(out) == limit:
+            return out, last
+
+        item['service'] = journal.service
+        item['type'] = journal.type
+        out.append(item)
+        last = position
+
+    return out, None
+
+def cache_items(key, items, limit):
+    # pass items through, and cache them as a list under key
+    # once they're all consumed, unless there were over limit
+    cached = []
+    for item in items:
+        if cached is not None:
+            cached.append(item)
+            if len(cached) > limit:
+                cached = None
+        yield item
+
+    if cached is not None:
+        cache.set(key, cached, settings.EVENTS_CACHE_TIME)
+
+
 def log_request_time(view_func, logfunc=logging.info):
     def inner(request, *args, **kwargs):
         start = time.time()
@@ -122,51 +471,232 @@ def events(request, service, type, since):
         return JsonResponse('POST requests require service and type')
 
     if request.method == 'GET':
-        out = []
-        for journal in user.journals(service=service, type=type, last_timestamp=since):
-            for item in journal:
-                if since and item['timestamp'] < since:
-                    continue
-                item['service'] = journal.service
-                item['type'] = journal.type
-                out.append(item)
-        
-        return JsonResponse(out)
+        version = cache.stream_version(user, service, type)
+        etag = stream_etag(request, version, since)
+
+        # long poll: if there is nothing new, hold the request
+        # until the stream is written to, or the wait runs out
+        if 'wait' in request.GET and (etag_matches(request, etag) or stream_last_timestamp(user, service, type, version) < since):
+            try:
+                wait = min(float(request.GET['wait']), settings.LONG_POLL_MAX_WAIT)
+            except ValueError:
+                return JsonResponse(message='Invalid wait', error=True)
+
+            if notify.wait_for_write(user, service, type, version, wait, settings.LONG_POLL_INTERVAL):
+                version = cache.stream_version(user, service, type)
+                etag = stream_etag(request, version, since)
+
+        # most polls find nothing new; answer those from the cached
+        # write version alone, without touching the datastore
+        if etag_matches(request, etag):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+    if request.method == 'GET' and ('limit' in request.GET or 'cursor' in request.GET):
+        # paged: journals ending before the cursor's timestamp
+        # are never fetched, and the page is small enough to
+        # build in memory, which the cursor header requires
+        try:
+            limit = int(request.GET.get('limit', settings.EVENTS_PAGE_SIZE))
+            if limit < 1:
+                raise ValueError('limit must be at least 1')
+            limit = min(limit, settings.EVENTS_MAX_PAGE_SIZE)
+            cursor = request.GET.get('cursor')
+            if cursor is not None:
+                cursor = decode_cursor(cursor)
+                since = max(since, cursor[0])
+        except ValueError, e:
+            return JsonResponse(message='Invalid paging parameters', detail=str(e), error=True)
+
+        journals = user.journals(service=service, type=type, last_timestamp=since)
+        out, position = page_events(journals, since, limit, cursor)
+
+        response = EventsResponse(request, out)
+        response['ETag'] = etag
+        if position is not None:
+            response['X-Synk-Cursor'] = encode_cursor(position)
+        return response
+
+    elif request.method == 'GET':
+        # cache the events since the start of the bucket since
+        # falls in, so that nearby since values (e.g. the same
+        # poll from several devices) share an entry
+        bucket = since - since % settings.EVENTS_CACHE_BUCKET
+        version = cache.stream_version(user, service, type)
+        key = 'events:%s:%s:%s:%d:%s' % (user.key(), service, type or '*', bucket, version)
+
+        events = cache.get(key)
+        if events is None:
+            journals = user.journals(service=service, type=type, last_timestamp=bucket)
+            events = journal_events(journals, bucket, is_keyed(service, type))
+            events = cache_items(key, events, settings.EVENTS_CACHE_MAX_EVENTS)
+
+        response = EventsResponse(request, (item for item in events if item['timestamp'] >= since))
+        response['ETag'] = etag
+        return response
 
     elif request.method == 'POST':
         try:
-            items = validate_put_post(request.raw_post_data)
+            items = validate_put_post(post_body(request), content_type=request.META.get('CONTENT_TYPE'))
         except Exception, e:
             return JsonResponse(mesage='Invalid JSON Schema', detail=str(e), error=True)
 
+        assign_batch_ids(request, items)
         items.sort(key=lambda item: item['timestamp'])
+        items = drop_duplicates(user, service, type, items)
+        if not items:
+            return JsonResponse('OK')
+
+        # write the items as new segments rather than loading and
+        # rewriting the latest journal, so that the cost of a POST
+        # depends only on its own size. readers merge the segments
+        # and compaction folds them into full journals later. all
+        # of the segments go in a single datastore call
+        segments = stream_segments(user, service, type, items)
+        put_journals(segments)
+        cache.bump_stream_version(user, service, type, items[-1]['timestamp'], segments_added(segments))
+        notify.notify(user, service, type)
+
+        return JsonResponse('OK')
 
+    return JsonResponse(message='Could not process request', error=True)
+
+def stream_segments(user, service, type, items):
+    # pack items (sorted by timestamp) into as many new,
+    # unsaved segments as the journal byte budget requires
+    segments = [Journal(user=user, service=service, type=type, segment=True)]
+    for item in items:
         try:
-            last_journal = tuple(user.journals(service, type, limit=1))[0]
-        except:
-            last_journal = Journal()
-            last_journal.user = user
-            last_journal.service = service
-            last_journal.type = type
+            segments[-1].append(item)
+        except JournalError:
+            segments.append(Journal(user=user, service=service, type=type, segment=True))
+            segments[-1].append(item)
+    return segments
+
+def segments_added(segments):
+    # (events, bytes) added to a stream by putting segments
+    return sum([len(segment) for segment in segments]), sum([segment.size for segment in segments])
+
+def parse_streams(streams):
+    # "rss/article,rss/browser,mail" => [('rss', 'article'),
+    # ('rss', 'browser'), ('mail', None)]
+    out = []
+    for stream in streams.split(','):
+        service, sep, type = stream.strip().partition('/')
+        if not service or (sep and not type) or '/' in type:
+            raise ValueError('invalid stream "%s"' % stream)
+        if type in ('', 'all'):
+            type = None
+        if (service, type) not in out:
+            out.append((service, type))
+    return out
 
-        for item in items:
-            try:
-                last_journal.append(item)
-            except JournalError, e:
-                last_journal.put()
-                last_journal = Journal()
-                last_journal.user = user
-                last_journal.service = service
-                last_journal.type = type
-                last_journal.append(item)
+@allow_method('GET', 'POST')
+@require_auth
+@log_request_time
+def multi_events(request):
+    """
+    GET the events of several streams, named in the "streams" query
+    parameter, merged into one response; or POST events for any
+    number of streams at once, where each item names its own service
+    and type, and the segments for every stream are written with a
+    single datastore call
+    """
+    user = request.user
 
-        last_journal.put()
+    if request.method == 'GET':
+        try:
+            since = int(request.GET.get('since', 0))
+            streams = parse_streams(request.GET.get('streams', ''))
+        except ValueError, e:
+            return JsonResponse(message='Invalid streams', detail=str(e), error=True)
+
+        # start every stream's query before reading from any of
+        # them: run() returns as soon as the query is issued, so
+        # they proceed in parallel on the datastore
+        queries = [user.journals(service=service, type=type, last_timestamp=since) for service, type in streams]
+        results = [query.run() for query in queries]
+
+        # a service and one of its types may both be asked for
+        journals = {}
+        for result in results:
+            for journal in result:
+                journals[str(journal.key())] = journal
+
+        keyed = any(is_keyed(service, type) for service, type in streams)
+        return EventsResponse(request, journal_events(journals.values(), since, keyed))
 
-        return JsonResponse('OK')
+    try:
+        items = validate_put_post(post_body(request), streams=True, content_type=request.META.get('CONTENT_TYPE'))
+    except Exception, e:
+        return JsonResponse(message='Invalid JSON Schema', detail=str(e), error=True)
+
+    assign_batch_ids(request, items)
+    items.sort(key=lambda item: item['timestamp'])
+
+    streams = {}
+    for item in items:
+        stream = (item.pop('service'), item.pop('type'))
+        streams.setdefault(stream, []).append(item)
+
+    segments = {}
+    for (service, type), stream_items in streams.items():
+        stream_items = drop_duplicates(user, service, type, stream_items)
+        if stream_items:
+            segments[(service, type)] = stream_segments(user, service, type, stream_items)
+        else:
+            del streams[(service, type)]
+    if segments:
+        put_journals([segment for stream in segments.values() for segment in stream])
 
-    return JsonResponse(message='Could not process request', error=True)
+    for (service, type), stream_items in streams.items():
+        cache.bump_stream_version(user, service, type, stream_items[-1]['timestamp'],
+                                  segments_added(segments[(service, type)]))
+        notify.notify(user, service, type)
+
+    return JsonResponse('OK')
+
+@allow_method('GET')
+@require_auth
+@log_request_time
+def summary(request, service):
+    """
+    GET the number of events, latest timestamp and stored size of
+    each type in a service, without decoding any journals
+
+    each POST carries the summary forward to the next version of
+    the service (see cache.bump_stream_version), so the journals,
+    which come with their blobs, are only fetched when that chain
+    is broken: by eviction, compaction or pruning
+    """
+    user = request.user
+
+    version = cache.stream_version(user, service)
+    out = cache.stream_summary(user, service, version)
+    if out is None:
+        out = {}
+        for journal in without_replaced(list(user.journals(service=service))):
+            stats = out.setdefault(journal.type, {'count': 0, 'last_timestamp': 0, 'size': 0})
+            stats['count'] += journal.count or 0
+            stats['last_timestamp'] = max(stats['last_timestamp'], journal.last_timestamp)
+            stats['size'] += journal.size or 0
+        cache.set_stream_summary(user, service, version, out)
+
+    return JsonResponse(out)
 
 @require_auth
 def account_test(request):
     return HttpResponse('')
 
+@allow_method('GET', 'POST')
+@require_digest_auth
+def account_token(request):
+    """
+    issue a bearer token, which authenticates later requests
+    without Digest authentication until it expires
+    """
+    user = request.user
+    expires = int(time.time()) + settings.TOKEN_LIFETIME
+    return JsonResponse(token=make_token(user.username, user.password_hash, expires), expires=expires)
+
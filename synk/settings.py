@@ -61,6 +61,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'synk.middleware.AllowedMethodsMiddleware',
     'synk.middleware.DigestMiddleware',
+    'synk.middleware.RateLimitMiddleware',
     #'django.contrib.sessions.middleware.SessionMiddleware',
     #'django.contrib.auth.middleware.AuthenticationMiddleware',
 )
@@ -75,6 +76,105 @@ TEMPLATE_DIRS = (
 
 APPEND_SLASH = False
 
+# approximate maximum size, in bytes, of the serialized
+# events in a single Journal. the datastore limits entities
+# to 1MB, so leave some room for the other properties
+JOURNAL_MAX_BYTES = 900000
+
+# journals with a fill factor (size / JOURNAL_MAX_BYTES) below
+# this are merged with their neighbours by the compaction job
+COMPACTION_FILL_FACTOR = 0.5
+
+# number of segments the compaction job looks at to find streams
+# to compact, and number of journals it scans at the end of each
+# stream, where new segments arrive. each scanned journal is fetched
+# whole, so keep the window small
+COMPACTION_BATCH_SIZE = 100
+COMPACTION_SCAN_LIMIT = 20
+
+# seconds the compaction job spends before leaving the rest of
+# its streams for the next run, to stay inside the request deadline
+COMPACTION_TIME_LIMIT = 20
+
+# how long to keep events, in seconds, keyed by "service" or
+# "service/type", e.g. {'rss/browser': 90 * 24 * 60 * 60}. the
+# pruning job deletes events older than that. when both a
+# service-wide and a per-type window apply, the shorter wins
+EVENT_RETENTION = {}
+
+# number of journals the pruning job deletes, and trims, per
+# retention window each time it runs. journals to trim are loaded
+# whole, one at a time, so there are fewer of those
+PRUNE_BATCH_SIZE = 200
+PRUNE_TRIM_SIZE = 20
+
+# streams which record the state of things, keyed by "service/type",
+# mapping to the name of the field which identifies the thing, e.g.
+# {'rss/article': 'guid'}. only the latest event for each value of
+# that field is returned by (unpaged) GETs or kept by compaction
+KEYED_STREAMS = {}
+
+# number of users, and of each user's journals, handled per
+# batch by the task which moves users to key-named entities
+MIGRATION_BATCH_SIZE = 50
+
+# seconds after moving a user's journals before the migrate_users
+# task moves any written meanwhile and deletes the old user. must
+# be longer than USER_CACHE_TIME plus the longest request
+MIGRATION_GRACE_TIME = 5 * 60
+
+# GET /events responses are cached for this many seconds (or
+# until the next POST to the stream), keyed by since rounded
+# down to a multiple of EVENTS_CACHE_BUCKET seconds
+EVENTS_CACHE_TIME = 60 * 60
+EVENTS_CACHE_BUCKET = 5 * 60
+
+# responses with more events than this are streamed straight
+# out without being cached
+EVENTS_CACHE_MAX_EVENTS = 5000
+
+# number of events per page when GET /events is given a
+# cursor but no limit
+EVENTS_PAGE_SIZE = 1000
+
+# largest limit a paged GET /events may ask for; larger ones
+# are reduced to it
+EVENTS_MAX_PAGE_SIZE = 10000
+
+# largest POST body accepted once decompressed, for POSTs
+# sent with a Content-Encoding
+MAX_POST_BYTES = 4 * 1024 * 1024
+
+# most events a binary (application/x-synk-events) POST body
+# may declare in its header
+MAX_POST_EVENTS = 50000
+
+# longest a GET /events?wait=N request is held waiting for new
+# events (requests must finish within 30 seconds), and how often
+# it checks for events POSTed to other processes meanwhile
+LONG_POLL_MAX_WAIT = 25
+LONG_POLL_INTERVAL = 1.0
+
+# number of users kept in each instance's cache for authenticating
+# requests, and for how many seconds (which bounds how long another
+# instance may accept a user's old password after it changes)
+USER_CACHE_SIZE = 1000
+USER_CACHE_TIME = 60
+
+# seconds a Digest authentication nonce remains valid after its
+# last use; clients may reuse a nonce for many requests until then
+DIGEST_NONCE_TIME = 60 * 60
+
+# seconds a bearer token from /account/token remains valid
+TOKEN_LIFETIME = 24 * 60 * 60
+
+# per-user limits on reads (GET) and writes (POST), as (tokens
+# per second, burst size): a user may make up to burst requests
+# at once, and one more each time a token comes back. requests
+# over the limit get a 429 status. None disables the limit
+READ_RATE_LIMIT = (5, 60)
+WRITE_RATE_LIMIT = (1, 20)
+
 INSTALLED_APPS = (
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -0,0 +1,327 @@
+import logging
+import time
+
+from django.conf import settings
+
+from google.appengine.ext import db
+
+from synk import cache
+from synk.models import *
+from synk.service import JsonResponse
+from synk.service import log_request_time
+
+# background jobs, run by cron (see cron.yaml). app.yaml
+# restricts the /tasks/ URLs to administrators
+
+
+def stream_journals(user, service, type, limit):
+    # newest journals of a single (user, service, type) stream.
+    # user may be a User or just its key
+    query = Journal.all()
+    query.filter('user =', user)
+    query.filter('service =', service)
+    query.filter('type =', type)
+    query.order('-last_timestamp')
+    return query.fetch(limit)
+
+def pending_streams(limit):
+    # distinct (user key, service, type) streams which have
+    # segments waiting to be compacted
+    streams = []
+    for segment in Journal.all().filter('segment =', True).fetch(limit):
+        stream = (Journal.user.get_value_for_datastore(segment), segment.service, segment.type)
+        if stream not in streams:
+            streams.append(stream)
+    return streams
+
+def stream_segments(user, service, type, limit):
+    # unsealed segments of a single stream, however old
+    query = Journal.all()
+    query.filter('user =', user)
+    query.filter('service =', service)
+    query.filter('type =', type)
+    query.filter('segment =', True)
+    return query.fetch(limit)
+
+def pack_journals(journals, index=None):
+    # rewrite the events of journals into as few full
+    # journals as the byte budget allows, dropping events
+    # replaced by later ones if given the stream's key_index
+    first = journals[0]
+    user = Journal.user.get_value_for_datastore(first)
+
+    pairs = merge_journals(journals)
+    if index is not None:
+        pairs = latest_by_key(pairs, index)
+
+    out = [Journal(user=user, service=first.service, type=first.type)]
+    for journal, item in pairs:
+        try:
+            out[-1].append(item)
+        except JournalError:
+            out.append(Journal(user=user, service=first.service, type=first.type))
+            out[-1].append(item)
+
+    # every event of a keyed stream's journals may have been replaced
+    return [journal for journal in out if len(journal)]
+
+def compact_stream(user, service, type):
+    """
+    merge runs of adjacent under-filled journals of a stream
+    into full ones. for keyed streams, journals holding events
+    replaced by a later event with the same key are also
+    rewritten without them. returns (journals removed, journals
+    written)
+
+    only the newest COMPACTION_SCAN_LIMIT journals are scanned,
+    since that is where new segments arrive; older segments are
+    just sealed
+
+    journals are never modified once put, so this is safe to run
+    while POSTs are adding segments to the stream: a segment put
+    after the scan is simply left for the next run. the merged
+    journals are put before the originals are deleted, and record
+    which journals they replace, so that readers skip the
+    originals if the delete never happens, and the next run
+    deletes them
+    """
+    journals = stream_journals(user, service, type, settings.COMPACTION_SCAN_LIMIT)
+    journals.reverse()
+
+    # finish off an earlier run which died between its put and
+    # its delete
+    journals, scanned = without_replaced(journals), journals
+    kept = set([str(journal.key()) for journal in journals])
+    stale = [journal for journal in scanned if str(journal.key()) not in kept]
+
+    runs = [[]]
+    for journal in journals:
+        if journal.fill_factor is not None and journal.fill_factor < settings.COMPACTION_FILL_FACTOR:
+            runs[-1].append(journal)
+        elif runs[-1]:
+            runs.append([])
+    runs = [run for run in runs if len(run) > 1]
+
+    index = None
+    if is_keyed(service, type):
+        # found from the journals' event_keys, without decoding
+        # them; only journals with replaced events are rewritten,
+        # on their own if they are not part of a run
+        index = key_index(journals)
+        in_runs = set([str(journal.key()) for run in runs for journal in run])
+        for journal in journals:
+            if str(journal.key()) not in in_runs and replaced_events(journal, index):
+                runs.append([journal])
+
+    to_put = []
+    to_delete = []
+    for run in runs:
+        merged = pack_journals(run, index)
+        for journal in merged:
+            journal.replaces = [old.key() for old in run]
+        to_put.extend(merged)
+        to_delete.extend(run)
+
+    # seal every other segment, including any too old to have
+    # been scanned, so it is not picked up again until a
+    # neighbour arrives. the blobs are unchanged, so put them
+    # directly rather than with put_journals
+    seen = set([str(journal.key()) for journal in to_delete + stale])
+    to_seal = []
+    for journal in journals + stream_segments(user, service, type, settings.COMPACTION_SCAN_LIMIT):
+        if journal.segment and str(journal.key()) not in seen:
+            seen.add(str(journal.key()))
+            journal.segment = False
+            to_seal.append(journal)
+
+    if to_put:
+        put_journals(to_put)
+    if to_seal:
+        db.put(to_seal)
+    if to_delete or stale:
+        db.delete(to_delete + stale)
+
+    if to_put or to_delete or stale:
+        # the summary counts and sizes are out of date, so move the
+        # version on without carrying it forward; the newest event
+        # is never dropped, so the last timestamp is
+        cache.bump_stream_version(user, service, type, journals and journals[-1].last_timestamp or None)
+
+    return len(to_delete) + len(stale), len(to_put) + len(to_seal)
+
+
+@log_request_time
+def compact(request):
+    deadline = time.time() + settings.COMPACTION_TIME_LIMIT
+    removed = written = 0
+    for user, service, type in pending_streams(settings.COMPACTION_BATCH_SIZE):
+        if time.time() > deadline:
+            break
+        r, w = compact_stream(user, service, type)
+        removed += r
+        written += w
+
+    logging.info('compaction removed %d journals, wrote %d', removed, written)
+    return JsonResponse(removed=removed, written=written)
+
+
+def retention_policies(now=None):
+    # (service, type, cutoff timestamp) for each configured
+    # retention window; type is None for service-wide ones
+    if now is None:
+        now = int(time.time())
+
+    policies = []
+    for stream, seconds in settings.EVENT_RETENTION.items():
+        if '/' in stream:
+            service, type = stream.split('/', 1)
+        else:
+            service, type = stream, None
+        policies.append((service, type, now - seconds))
+    return policies
+
+def policy_query(service, type, keys_only=False):
+    query = db.Query(Journal, keys_only=keys_only)
+    query.filter('service =', service)
+    if type is not None:
+        query.filter('type =', type)
+    return query
+
+def prune_policy(service, type, cutoff):
+    """
+    delete the journals of service (and type, if given) whose
+    events are all older than cutoff, and trim the older events
+    out of journals which straddle it. returns (journals deleted,
+    journals trimmed)
+
+    trimming is the one place a journal is rewritten after being
+    put; a compaction of the same stream running at the same time
+    could bring the trimmed events back until the next run
+    """
+    # whole journals go with a keys-only query and a batched
+    # delete, without fetching the blobs
+    query = policy_query(service, type, keys_only=True)
+    query.filter('last_timestamp <', cutoff)
+    expired = query.fetch(settings.PRUNE_BATCH_SIZE)
+    if expired:
+        db.delete(expired)
+
+    # with those gone, any journal left which starts before the
+    # cutoff must straddle it; skip ones the (eventually
+    # consistent) query still returns after the delete above.
+    # each is loaded and rewritten on its own, so that only one
+    # blob is held at a time
+    query = policy_query(service, type, keys_only=True)
+    query.filter('first_timestamp <', cutoff)
+
+    trimmed = emptied = 0
+    for key in query.fetch(settings.PRUNE_TRIM_SIZE):
+        journal = db.get(key)
+        if journal is None or journal.last_timestamp < cutoff:
+            continue
+        journal.events = journal.events_since(cutoff)
+        if journal.events:
+            put_journals([journal])
+            trimmed += 1
+        else:
+            db.delete(journal)
+            emptied += 1
+
+    return len(expired) + emptied, trimmed
+
+
+@log_request_time
+def prune(request):
+    deleted = trimmed = 0
+    for service, type, cutoff in retention_policies():
+        d, t = prune_policy(service, type, cutoff)
+        if d or t:
+            # so cached GETs, summaries and ETags stop showing
+            # the pruned events
+            cache.bump_prune_generation(service)
+        deleted += d
+        trimmed += t
+
+    logging.info('pruning deleted %d journals, trimmed %d', deleted, trimmed)
+    return JsonResponse(deleted=deleted, trimmed=trimmed)
+
+
+def move_journals(old, user):
+    # point every journal of old at user. the blobs are unchanged,
+    # so put them directly rather than with put_journals, which
+    # would re-encode them
+    while True:
+        journals = Journal.all().filter('user =', old).fetch(settings.MIGRATION_BATCH_SIZE)
+        if not journals:
+            break
+        for journal in journals:
+            journal.user = user
+        db.put(journals)
+
+def migrate_user(old, now=None):
+    """
+    move a user created before users were stored by key name to
+    a new, key-named entity, and point its journals at it. returns
+    True once the old user has been deleted
+
+    other instances may keep using the old entity until their
+    caches expire, and write journals under it meanwhile. so the
+    old user is kept, marked as migrated, and only deleted by a
+    run MIGRATION_GRACE_TIME later, once those journals have been
+    moved too
+    """
+    if now is None:
+        now = int(time.time())
+
+    user = User.get_by_key_name(User.key_name_for(old.username))
+    if user is None:
+        user = User(key_name=User.key_name_for(old.username), username=old.username,
+                    password_hash=old.password_hash)
+        user.put()
+
+    if old.migrated is None:
+        # from here on, this instance and memcache hand out the
+        # new user; other instances follow within USER_CACHE_TIME
+        User.forget(old.username)
+        move_journals(old, user)
+        old.migrated = now
+        old.put()
+        return False
+
+    if now - old.migrated < settings.MIGRATION_GRACE_TIME:
+        return False
+
+    # the last of the writes under the old user are done
+    move_journals(old, user)
+    db.delete(old)
+    User.forget(old.username)
+    return True
+
+
+@log_request_time
+def migrate_users(request):
+    # one batch of users, in key order starting after the
+    # "start" parameter; the response gives the start of the
+    # next batch, or null once every user has been looked at.
+    # users are only deleted by a run MIGRATION_GRACE_TIME after
+    # the one which moved them, so keep running batches from the
+    # start until "pending" is 0
+    query = User.all().order('__key__')
+    if request.GET.get('start'):
+        query.filter('__key__ >', db.Key(request.GET['start']))
+    users = query.fetch(settings.MIGRATION_BATCH_SIZE)
+
+    migrated = pending = 0
+    for user in users:
+        if user.key().name() is None:
+            if migrate_user(user):
+                migrated += 1
+            else:
+                pending += 1
+
+    start = None
+    if len(users) == settings.MIGRATION_BATCH_SIZE:
+        start = str(users[-1].key())
+
+    logging.info('migrated %d users, %d pending', migrated, pending)
+    return JsonResponse(migrated=migrated, pending=pending, next=start)
@@ -0,0 +1,60 @@
+import base64
+import hashlib
+import hmac
+import time
+
+from django.conf import settings
+
+__all__ = ['make_token', 'check_token', 'password_fingerprint', 'password_matches']
+
+def _signature(payload):
+    return hmac.new(settings.SECRET_KEY, payload, hashlib.sha256).hexdigest()
+
+def _equal(a, b):
+    # compare in time independent of where they differ, so the
+    # signature cannot be guessed a character at a time
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def password_fingerprint(password_hash):
+    # identifies a user's password without revealing its hash,
+    # so that changing the password invalidates their tokens
+    return _signature('password:%s' % password_hash)[:16]
+
+def password_matches(fingerprint, password_hash):
+    return _equal(fingerprint, password_fingerprint(password_hash))
+
+def make_token(username, password_hash, expires):
+    """
+    return a bearer token for username, valid until the
+    UNIX timestamp expires or the password is changed
+    """
+    payload = base64.urlsafe_b64encode('%s:%s:%d' % (username, password_fingerprint(password_hash), expires))
+    return '%s.%s' % (payload, _signature(payload))
+
+def check_token(token, now=None):
+    """
+    return (username, password fingerprint) for a token, or None
+    if it is malformed, has been tampered with or has expired.
+    this needs nothing but the secret key, so costs no datastore
+    access at all; the caller must check that the fingerprint
+    still matches the user's password (see password_matches)
+    """
+    if now is None:
+        now = time.time()
+
+    try:
+        payload, signature = str(token).split('.', 1)
+        if not _equal(signature, _signature(payload)):
+            return None
+        username, fingerprint, expires = base64.urlsafe_b64decode(payload).rsplit(':', 2)
+        if int(expires) < now:
+            return None
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+    return username, fingerprint
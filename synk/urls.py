@@ -8,11 +8,21 @@ urlpatterns = patterns('synk',
 
     # API URLs
     (r'^account/test$', 'service.account_test'),
+    (r'^account/token$', 'service.account_token'),
+
+    (r'^events$', 'service.multi_events'),
 
     (r'^events/(?P<service>[^/]+)$', 'service.events', {'type': None, 'since': 0}),
     (r'^events/(?P<service>[^/]+)/since/(?P<since>[^/]+)$', 'service.events', {'type': None}),
 
+    (r'^events/(?P<service>[^/]+)/summary$', 'service.summary'),
+
     (r'^events/(?P<service>[^/]+)/(?P<type>[^/]+)$', 'service.events', {'since': 0}),
     (r'^events/(?P<service>[^/]+)/(?P<type>[^/]+)/since/(?P<since>[^/]+)$', 'service.events'),
+
+    # background jobs
+    (r'^tasks/compact$', 'tasks.compact'),
+    (r'^tasks/prune$', 'tasks.prune'),
+    (r'^tasks/migrate_users$', 'tasks.migrate_users'),
 )
 
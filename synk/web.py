@@ -23,12 +23,11 @@ def register(request):
     if request.method == 'POST':
         form = UserForm(request.POST)
         if form.is_valid():
-            u = User()
-            u.username = request.POST['username']
-            u.set_password(request.POST['password'])
-            u.put()
+            u = User.create(request.POST['username'], request.POST['password'])
+            if u is not None:
+                return HttpResponseRedirect('/')
 
-            return HttpResponseRedirect('/')
+            form.errors['username'] = ['That username is already in use']
     
     return render(request, 'register.html',
             form=form,